@@ -1,12 +1,23 @@
 import streamlit as st
 import pandas as pd
-import difflib
 import tldextract
 import seaborn as sns
-import requests
+import httpx
+import io
+import ijson
 import json
+import os
+import re
+import tempfile
+import threading
+import time
 import matplotlib.pyplot as plt
 import numpy as np
+from numba import njit, prange
+from rapidfuzz import process, fuzz
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from datetime import date
+from urllib.parse import urlsplit
 
 # Set page configuration
 st.set_page_config(
@@ -22,10 +33,75 @@ This tool allows you to compare the similarity between search engine results pag
 It helps identify keyword cannibalization issues and improve your SEO strategy.
 """)
 
-# Function to call ValueSERP API
-def serp(api_key, query, location="United States", num_results="9"):
+# Default number of concurrent ValueSERP requests (keeps us within typical plan limits)
+MAX_WORKERS = 5
+
+# Number of times a rate-limited (429) request is retried, and the longest backoff between attempts in seconds
+MAX_RETRIES = 4
+MAX_BACKOFF = 60
+
+# Prefixes of the parse events kept from a SERP response: top-level lists, their items and the items' URL fields
+RESULT_ITEM_RE = re.compile(r"^([^.]+)\.item$")
+RESULT_URL_RE = re.compile(r"^([^.]+)\.item\.(link|url|displayed_link)$")
+
+# Function to stream-parse a SERP response, keeping only the URL fields of each top-level result list.
+# Returns e.g. {"organic_results": [{"link": ...}, ...]} without ever materialising the full payload
+def parse_serp_links(chunks):
+    results = {}
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    
+    def collect():
+        for prefix, event, value in events:
+            if event == "start_array" and prefix and "." not in prefix:
+                results[prefix] = []
+            elif event == "start_map" and RESULT_ITEM_RE.match(prefix):
+                results[prefix[:-len(".item")]].append({})
+            elif event == "string":
+                match = RESULT_URL_RE.match(prefix)
+                if match:
+                    results[match.group(1)][-1][match.group(2)] = value
+                elif prefix == "error":
+                    results["error"] = value
+        del events[:]
+    
+    for chunk in chunks:
+        parser.send(chunk)
+        collect()
+    parser.close()
+    collect()
+    
+    return results
+
+# Shared HTTP/2 connection pool, kept alive across reruns and sessions so the TLS handshake to ValueSERP is paid once
+@st.cache_resource
+def get_http_client():
+    return httpx.Client(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16)
+    )
+
+# Function to get how long to wait before retrying a rate-limited request.
+# Honours a Retry-After header in seconds, otherwise backs off exponentially (1s, 2s, 4s, ...)
+def get_retry_delay(response, attempt):
+    retry_after = response.headers.get("Retry-After", "")
+    delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+    return min(delay, MAX_BACKOFF)
+
+# Raised when ValueSERP does not return usable results (never cached)
+class SerpAPIError(Exception):
+    pass
+
+# Function to call ValueSERP API.
+# Responses are persisted to disk so they survive restarts. Streamlit ignores ttl for disk caches, so callers pass
+# today's date as fetched_on: it is only part of the cache key, and makes cached SERPs expire daily.
+# Evicted entries are never deleted from disk, so prune_serp_cache() clears earlier days' files.
+# The client and API key are underscore-prefixed so they are not hashed
+@st.cache_data(persist="disk", max_entries=5000, show_spinner=False)
+def serp(_client, _api_key, query, location="United States", num_results="9", fetched_on=None):
     params = {
-        "api_key": api_key,
+        "api_key": _api_key,
         "q": query,
         "location": location,
         "hl": "en",
@@ -37,32 +113,86 @@ def serp(api_key, query, location="United States", num_results="9"):
         "flatten_results": "true"  # Get flattened results structure
     }
     
-    # Make the HTTP GET request to ValueSERP
-    api_result = requests.get('https://api.valueserp.com/search', params)
-    
-    # Check if the request was successful
-    if api_result.status_code == 200:
+    # Make the HTTP GET request to ValueSERP, backing off and retrying while rate limited
+    for attempt in range(MAX_RETRIES + 1):
         try:
-            return api_result.json()
-        except Exception as e:
-            st.error(f"Error parsing API response: {str(e)}")
-            return {"error": "Failed to parse response"}
-    else:
-        if api_result.status_code == 402:
-            st.error("Payment Required: Your ValueSERP API key may be invalid, out of credits, or requires a subscription. Please check your account at ValueSERP.")
-            st.info("If you're using a trial key, you may need to upgrade to a paid plan to continue using the API.")
-            return {"error": "Payment required for API access"}
-        else:
-            st.error(f"API request failed with status code: {api_result.status_code}")
+            with _client.stream("GET", 'https://api.valueserp.com/search', params=params) as api_result:
+                # Check if the request was successful.
+                # Errors are raised rather than displayed, since this runs on worker threads and failures must not be cached
+                if api_result.status_code == 200:
+                    try:
+                        results = parse_serp_links(api_result.iter_bytes())
+                    except ijson.JSONError as e:
+                        raise SerpAPIError(f"Error parsing API response: {str(e)}")
+                    
+                    # ValueSERP can report errors with a 200 status
+                    if "error" in results:
+                        raise SerpAPIError(results["error"])
+                    return results
+                api_result.read()
+        except httpx.HTTPError as e:
+            raise SerpAPIError(f"Request to ValueSERP failed: {str(e)}")
         
-        try:
-            error_json = api_result.json()
-            return {"error": error_json.get("error", f"Status code: {api_result.status_code}")}
-        except:
-            return {"error": f"Status code: {api_result.status_code}"}
+        if api_result.status_code != 429 or attempt == MAX_RETRIES:
+            break
+        time.sleep(get_retry_delay(api_result, attempt))
+    
+    if api_result.status_code == 429:
+        raise SerpAPIError("Rate limited by ValueSERP: too many requests. Try lowering 'Max concurrent requests' in the sidebar.")
+    
+    if api_result.status_code == 402:
+        raise SerpAPIError("Payment Required: Your ValueSERP API key may be invalid, out of credits, or requires a subscription. Please check your account at ValueSERP. If you're using a trial key, you may need to upgrade to a paid plan to continue using the API.")
+    
+    try:
+        error_message = api_result.json().get("error", f"API request failed with status code: {api_result.status_code}")
+    except:
+        error_message = f"API request failed with status code: {api_result.status_code}"
+    raise SerpAPIError(error_message)
+
+# Date the SERP disk cache was started; persisted too, so it survives restarts alongside the cached SERPs
+@st.cache_data(persist="disk", show_spinner=False)
+def get_serp_cache_date():
+    return date.today().isoformat()
+
+# Function to drop earlier days' SERPs from the disk cache once the date changes
+def prune_serp_cache(fetched_on):
+    if get_serp_cache_date() != fetched_on:
+        serp.clear()
+        get_serp_cache_date.clear()
+        get_serp_cache_date()
+
+# Shared tldextract instance; the bundled Public Suffix List snapshot is parsed once per process
+@st.cache_resource
+def get_extractor():
+    return tldextract.TLDExtract(suffix_list_urls=(), cache_dir=os.path.join(tempfile.gettempdir(), "tldextract"))
 
-# Function to extract domains from SERP
-def get_serp_comp(results):
+# Top-level domains that have multi-label public suffixes (e.g. "uk" for "co.uk"); only these need the full PSL lookup
+@st.cache_resource
+def get_multi_label_tlds():
+    return frozenset(suffix.rsplit(".", 1)[-1] for suffix in get_extractor().tlds if "." in suffix)
+
+# Registrable domain of a host whose public suffix is a single label (e.g. "example.com")
+DOMAIN_RE = re.compile(r"(?:[^.]+\.)*([^.]+\.[^.]+)$")
+
+# Function to get the registrable domain of a URL
+def get_domain(url, extract, multi_label_tlds):
+    try:
+        host = urlsplit(url).hostname or ""
+    except ValueError:
+        # urlsplit rejects some malformed links (e.g. an unclosed IPv6 bracket) that tldextract accepts
+        host = ""
+    match = DOMAIN_RE.match(host)
+    if match:
+        tld = host.rsplit(".", 1)[-1]
+        if tld not in multi_label_tlds and not tld.isdigit():
+            return match.group(1)
+    
+    # Multi-label suffixes, IP addresses and malformed URLs need the full Public Suffix List
+    ext = extract(url)
+    return (ext.domain + '.' + ext.suffix).lower()
+
+# Function to extract domains (or full URLs) from SERP
+def get_serp_comp(results, full_url=False):
     serp_comp = []
     
     try:
@@ -103,7 +233,9 @@ def get_serp_comp(results):
                 st.error("Could not find any suitable organic results in the response")
                 return []
                 
-        # Extract domains
+        # Extract domains or full URLs
+        extract = get_extractor()
+        multi_label_tlds = get_multi_label_tlds()
         for item in results[organic_key]:
             # Find the URL field (might be 'link' or 'url')
             url = None
@@ -114,10 +246,10 @@ def get_serp_comp(results):
             elif "displayed_link" in item:
                 url = item["displayed_link"]
                 
-            if url:
-                ext = tldextract.extract(url)
-                domain = ext.domain + '.' + ext.suffix
-                serp_comp.append(domain)
+            if url and full_url:
+                serp_comp.append(url)
+            elif url:
+                serp_comp.append(get_domain(url, extract, multi_label_tlds))
             
     except Exception as e:
         st.error(f"Error processing results: {str(e)}")
@@ -128,25 +260,130 @@ def get_serp_comp(results):
         
     return serp_comp
 
+# Function to average each keyword's similarity to every other keyword (excluding itself), as whole percentages.
+# Keywords with no results (failed or empty fetches) are left out of every average and reported as 0,
+# as is a keyword with results when no other keyword has any to compare against
+def get_mean_similarity(matrix, empty):
+    valid = ~empty
+    others = valid.sum() - 1
+    if others < 1:
+        return [0] * len(valid)
+    
+    sums = matrix[:, valid].sum(axis=1) - np.where(valid, np.diag(matrix), 0)
+    means = np.where(valid, sums / others, 0)
+    return (means * 100).round().astype(int).tolist()
+
+# Function to intern every domain/URL to an integer id shared across all SERPs.
+# Returns one flat int32 array of ids plus offsets, so SERP i is flat[offsets[i]:offsets[i + 1]]
+def flatten_serps(serp_comp):
+    vocab = {}
+    flat = np.fromiter(
+        (vocab.setdefault(item, len(vocab)) for serp in serp_comp for item in serp),
+        dtype=np.int32,
+        count=sum(len(serp) for serp in serp_comp)
+    )
+    offsets = np.cumsum([0] + [len(serp) for serp in serp_comp], dtype=np.int64)
+    return flat, offsets
+
+# Function to collapse identical SERPs so each distinct one is scored only once.
+# Takes a hashable key per SERP; returns the index of the first SERP with each distinct key and,
+# for every input SERP, the index of its distinct copy
+def dedupe_serps(keys):
+    distinct = {}
+    inverse = np.array([distinct.setdefault(key, len(distinct)) for key in keys])
+    _, first = np.unique(inverse, return_index=True)
+    return first, inverse
+
 # Function to calculate SERP difference percentages
 def get_keyword_serp_diffs(serp_comp):
-    diffs = []
-    keyword_diffs = []
+    n = len(serp_comp)
+    if n < 2:
+        return [100 if serp else 0 for serp in serp_comp]
+    
+    # Compare short int sequences rather than lists of strings, scoring identical SERPs only once
+    flat, offsets = flatten_serps(serp_comp)
+    first, inverse = dedupe_serps(flat[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:]))
+    distinct = [flat[offsets[i]:offsets[i + 1]].tolist() for i in first]
+    
+    # Similarity matrix of the distinct SERPs computed in C++, scaled 0-1. This is the Indel ratio
+    # 2 * LCS / (len1 + len2): close to, but not the same as, difflib's Ratcliff-Obershelp ratio.
+    # Passing the same list as queries and choices lets cdist score only one triangle of the symmetric matrix.
+    # The exact ratio is a bit-parallel LCS, linear in SERP length, so no quick_ratio-style upper-bound prefilter is needed
+    matrix = process.cdist(distinct, distinct, scorer=fuzz.ratio, workers=-1, dtype=np.float32)
+    matrix /= 100
+    matrix = matrix[np.ix_(inverse, inverse)]
+    
+    return get_mean_similarity(matrix, np.diff(offsets) == 0)
+
+# Function to compile the pairwise overlap kernel.
+# Cached as a resource because Streamlit re-executes this script on every rerun, which would otherwise recompile it.
+# No spinner, since it is first called from the background similarity thread
+@st.cache_resource(show_spinner=False)
+def get_overlap_kernel():
+    @njit("float32[:, :](int32[:], int64[:])", parallel=True, fastmath=True)
+    def pairwise_overlap(ids, starts):
+        n = len(starts) - 1
+        matrix = np.zeros((n, n), dtype=np.float32)
+        for i in prange(n):
+            matrix[i, i] = 1.0
+            for j in range(i + 1, n):
+                # Intersection size of the two sorted, de-duplicated id slices
+                a, a_end = starts[i], starts[i + 1]
+                b, b_end = starts[j], starts[j + 1]
+                count = 0
+                while a < a_end and b < b_end:
+                    if ids[a] == ids[b]:
+                        count += 1
+                        a += 1
+                        b += 1
+                    elif ids[a] < ids[b]:
+                        a += 1
+                    else:
+                        b += 1
+                
+                # Jaccard is symmetric, so mirror it into the lower triangle
+                union = (starts[i + 1] - starts[i]) + (starts[j + 1] - starts[j]) - count
+                score = count / union if union > 0 else 0.0
+                matrix[i, j] = score
+                matrix[j, i] = score
+        return matrix
     
-    for x in serp_comp:
-        diffs = []
-        for y in serp_comp:
-            if x != y:
-                sm = difflib.SequenceMatcher(None, x, y)
-                diffs.append(sm.ratio())
-        try:    
-            keyword_diffs.append(round(sum(diffs)/len(diffs), 2))
-        except:
-            keyword_diffs.append(1)
+    # Sessions run on separate threads, and Numba's default workqueue threading layer aborts the
+    # process on concurrent parallel calls, so only one call runs at a time (each already uses every core)
+    lock = threading.Lock()
     
-    keyword_diffs = [int(x*100) for x in keyword_diffs]
+    def locked_pairwise_overlap(ids, starts):
+        with lock:
+            return pairwise_overlap(ids, starts)
     
-    return keyword_diffs
+    return locked_pairwise_overlap
+
+# Function to calculate SERP overlap (Jaccard) percentages
+def get_keyword_serp_overlap(serp_comp):
+    n = len(serp_comp)
+    if n < 2:
+        return [100 if serp else 0 for serp in serp_comp]
+    
+    flat, offsets = flatten_serps(serp_comp)
+    
+    # Sort and de-duplicate the ids within each SERP's slice in one pass over the flat array
+    rows = np.repeat(np.arange(n), np.diff(offsets))
+    order = np.lexsort((flat, rows))
+    rows, flat = rows[order], flat[order]
+    keep = np.ones(len(flat), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (flat[1:] != flat[:-1])
+    rows, flat = rows[keep], flat[keep]
+    offsets = np.searchsorted(rows, np.arange(n + 1)).astype(np.int64)
+    
+    # Score SERPs with identical result sets only once
+    first, inverse = dedupe_serps(flat[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:]))
+    sets = [flat[offsets[i]:offsets[i + 1]] for i in first]
+    starts = np.cumsum([0] + [len(serp) for serp in sets], dtype=np.int64)
+    
+    matrix = get_overlap_kernel()(np.concatenate(sets), starts)
+    matrix = matrix[np.ix_(inverse, inverse)]
+    
+    return get_mean_similarity(matrix, np.diff(offsets) == 0)
 
 # Sidebar for API key input
 with st.sidebar:
@@ -169,6 +406,30 @@ with st.sidebar:
         help="Domain only compares website domains. Full URL compares complete URLs for more granular analysis."
     )
     
+    # Similarity metric
+    metric = st.radio(
+        "Similarity Metric",
+        ["Rank order", "Result overlap (Jaccard)"],
+        help="Rank order compares the ordered result lists. Result overlap compares which results appear, ignoring position."
+    )
+    
+    # Concurrency limit for API requests
+    max_workers = st.slider(
+        "Max concurrent requests",
+        min_value=1,
+        max_value=16,
+        value=MAX_WORKERS,
+        help="How many keywords are fetched from ValueSERP at once. Lower this if your plan's rate limit returns errors."
+    )
+    
+    # Discard cached SERPs (one-shot, so later runs use the cache again)
+    if st.button(
+        "Clear cached SERPs",
+        help="Discard cached search results so the next analysis fetches fresh SERPs from ValueSERP (uses API credits)."
+    ):
+        serp.clear()
+        st.success("Cached SERPs cleared")
+    
     st.markdown("---")
     st.markdown("Created based on [ImportSEM tutorial](https://importsem.com/compare-keyword-serp-similarity-in-bulk-with-python/)")
 
@@ -238,53 +499,56 @@ with col2:
 if process_button:
     with st.spinner('Analyzing keyword SERPs...'):
         try:
-            serp_comp_list = []
             progress_bar = st.progress(0)
+            status = st.empty()
             
-            # Process each keyword
-            for i, keyword in enumerate(keywords):
-                st.text(f"Processing: {keyword}")
-                
-                # Call ValueSERP API
-                results = serp(api_key, keyword, location, num_results)
-                
+            # Fetch all keyword SERPs concurrently; the requests are network-bound
+            def fetch(keyword):
+                try:
+                    return keyword, serp(client, api_key, keyword, location, num_results, fetched_on)
+                except SerpAPIError as e:
+                    return keyword, {"error": str(e)}
+            
+            client = get_http_client()
+            fetched_on = date.today().isoformat()
+            prune_serp_cache(fetched_on)
+            results_list = [None] * len(keywords)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(fetch, keyword): i for i, keyword in enumerate(keywords)}
+                # Refresh the UI roughly 20 times in total rather than once per keyword
+                update_every = max(1, len(keywords) // 20)
+                for done, future in enumerate(as_completed(futures), start=1):
+                    keyword, results = future.result()
+                    results_list[futures[future]] = results
+                    if done % update_every == 0 or done == len(keywords):
+                        status.text(f"Processed {done}/{len(keywords)} keywords")
+                        progress_bar.progress(done / len(keywords))
+            
+            # Process each keyword's results in input order
+            serp_comp_list = []
+            for keyword, results in zip(keywords, results_list):
                 # Extract domains or URLs
-                if comp_type == "Domain only":
-                    serp_comp = get_serp_comp(results)
-                else:
-                    # Full URL comparison
-                    serp_comp = []
-                    try:
-                        # Navigate through Data for SEO response structure to find organic results
-                        if "tasks" in results and len(results["tasks"]) > 0:
-                            task = results["tasks"][0]
-                            
-                            if "result" in task and len(task["result"]) > 0:
-                                result_data = task["result"][0]
-                                
-                                if "items" in result_data:
-                                    # Filter out only organic results (not paid, featured snippets, etc)
-                                    organic_items = [item for item in result_data["items"] 
-                                                     if item.get("type") == "organic"]
-                                    
-                                    # Extract URLs from organic results
-                                    for item in organic_items[:10]:  # Limit to top 10 results
-                                        if "url" in item:
-                                            serp_comp.append(item["url"])
-                        
-                        # If no results were found
-                        if not serp_comp:
-                            st.warning(f"No organic results found for '{keyword}'")
-                    
-                    except Exception as e:
-                        st.error(f"Error processing results for '{keyword}': {str(e)}")
-                        continue
+                serp_comp = get_serp_comp(results, full_url=(comp_type == "Full URL"))
+                
+                if not serp_comp and "error" not in results:
+                    st.warning(f"No organic results found for '{keyword}'")
                 
                 serp_comp_list.append(serp_comp)
-                progress_bar.progress((i + 1) / len(keywords))
             
-            # Calculate similarity percentages
-            serp_comp_keyword = get_keyword_serp_diffs(serp_comp_list)
+            if len(keywords) > 1 and sum(1 for serp_comp in serp_comp_list if serp_comp) < 2:
+                st.warning("Fewer than two keywords returned results, so there is nothing to compare them against.")
+            
+            # Calculate similarity percentages on a background thread so the status keeps updating.
+            # Both kernels release the GIL and use every core themselves
+            get_similarity = get_keyword_serp_diffs if metric == "Rank order" else get_keyword_serp_overlap
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(get_similarity, serp_comp_list)
+                started = time.monotonic()
+                while not future.done():
+                    status.text(f"Calculating similarity... ({time.monotonic() - started:.0f}s)")
+                    wait([future], timeout=1)
+                serp_comp_keyword = future.result()
+            status.empty()
             
             # Create dataframe
             df = pd.DataFrame({
@@ -316,30 +580,23 @@ if process_button:
             bars = ax.barh(
                 df_sorted['Keyword'], 
                 df_sorted['Keyword SERP Similarity (%)'],
-                color=plt.cm.Greens(np.linspace(0.3, 0.8, len(keywords)))
+                color=plt.cm.Greens(np.linspace(0.3, 0.8, len(df_sorted)))
             )
             
             ax.set_xlabel('Similarity (%)')
             ax.set_title('Keyword SERP Similarity')
             
             # Add value labels
-            for bar in bars:
-                width = bar.get_width()
-                ax.text(
-                    width + 1, 
-                    bar.get_y() + bar.get_height()/2, 
-                    f'{width}%', 
-                    ha='left', 
-                    va='center'
-                )
+            ax.bar_label(bars, fmt='%d%%', padding=3)
             
             st.pyplot(fig)
             
-            # Allow download as CSV
-            csv = df.to_csv(index=False)
+            # Allow download as CSV, written straight to bytes
+            csv = io.BytesIO()
+            df.to_csv(csv, index=False)
             st.download_button(
                 label="Download results as CSV",
-                data=csv,
+                data=csv.getvalue(),
                 file_name="serp_similarity_results.csv",
                 mime="text/csv",
             )